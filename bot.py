@@ -149,8 +149,8 @@ class WikiGameBot():
         current_topic : str
             The current topic being analyzed in the game.
 
-        visited : list
-            A list of already visited topics to avoid repetition.
+        visited : set
+            A set of already visited topics to avoid repetition.
 
         Returns
         -------
@@ -169,7 +169,9 @@ class WikiGameBot():
         embs, top_n_pages, _ = get_most_similar_strings(self.target_summary, pages, n = top_n)
 
         # get the summary of top_n // 2 pages and get the most similar summary to target summary
-        top_n_summaries_to_pages = {get_page_summary(self.wiki_wiki.page(page)).strip() : page for page in top_n_pages[: top_n // 2] if get_page_summary(self.wiki_wiki.page(page)).strip()}
+        # (fetched concurrently, rather than one request after another)
+        top_half_pages = top_n_pages[: top_n // 2]
+        top_n_summaries_to_pages = {summary.strip() : page for page, summary in zip(top_half_pages, get_page_summaries(self.wiki_wiki, top_half_pages)) if summary.strip()}
         top_n_pages_to_summaries = {page : summary for summary, page in top_n_summaries_to_pages.items()}
         embs, top_n_pages, top_n_similarities = get_most_similar_strings(self.target_summary, list(top_n_summaries_to_pages.keys()), n = top_n)
         most_similar_topic, similarity_to_target = top_n_summaries_to_pages[top_n_pages[0]], top_n_similarities[0]
@@ -228,7 +230,7 @@ class WikiGameBot():
 
             # find most similar topic on current page to target topic
             visited.add(current_topic)
-            next_topic, similarity_to_target = self.take_turn(current_topic, list(visited))
+            next_topic, similarity_to_target = self.take_turn(current_topic, visited)
 
             # for turn time tracking
             turn_time = time.time() - turn_start
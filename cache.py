@@ -0,0 +1,357 @@
+import sqlite3
+import hashlib
+import pickle
+import zlib
+import time
+import threading
+import os
+import numpy as np
+import faiss
+
+
+class PageCache():
+    """
+    An on-disk cache of Wikipedia page summaries and validated links.
+
+    Fetching a page from Wikipedia is the slowest step of a turn, and the same topics come up again and again
+    across games. This class stores the summary and validated links of each fetched page in a local sqlite
+    database so that repeated topics are read from disk instead of being requested from Wikipedia.
+
+    Attributes
+    ----------
+    path : str
+        The path of the sqlite database file.
+    ttl : int
+        The number of seconds a cached page is considered fresh. Older entries are refetched.
+
+    Methods
+    -------
+    get(topic)
+        Returns the cached summary and links for a topic, or None if it is missing or stale.
+    put(topic, summary, links)
+        Stores the summary and links for a topic.
+    get_or_fetch(topic, fetch_fn)
+        Returns the cached summary and links for a topic, fetching and storing them on a miss.
+    get_topics()
+        Returns the titles of every fresh cached page.
+    get_embeddings(model, texts)
+        Returns the cached embeddings of the given texts for an embeddings model.
+    put_embeddings(model, embeddings)
+        Stores embeddings of texts for an embeddings model.
+    close()
+        Closes the database connection.
+    """
+    def __init__(self, path = "wiki_cache.sqlite", ttl = 30 * 24 * 60 * 60, namespace = "enwiki"):
+        """
+        Opens (or creates) the sqlite database backing the cache.
+
+        Parameters
+        ----------
+        path : str, optional
+            The path of the sqlite database file. Defaults to 'wiki_cache.sqlite'.
+
+        ttl : int, optional
+            The number of seconds a cached page is considered fresh, to pick up edits to Wikipedia. Defaults to 30 days.
+
+        namespace : str, optional
+            The wiki the cached pages come from. It is part of the cache key so pages from different wikis never
+            collide. Defaults to 'enwiki'.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.namespace = namespace
+        # the bot prefetches pages from worker threads, so share one connection behind a lock
+        self.conn = sqlite3.connect(path, check_same_thread = False)
+        self._lock = threading.Lock()
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS pages (
+                   key BLOB PRIMARY KEY,
+                   topic TEXT,
+                   summary TEXT,
+                   links BLOB,
+                   fetched_at INT
+               )"""
+        )
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS embeddings (
+                   key BLOB PRIMARY KEY,
+                   vector BLOB
+               )"""
+        )
+        self.conn.commit()
+
+    def _key(self, topic):
+        """Returns the SHA-256 cache key of a topic, scoped to the wiki namespace."""
+        return hashlib.sha256((self.namespace + "\0" + topic).encode()).digest()
+
+    def _embedding_key(self, model, text):
+        """Returns the SHA-256 cache key of a text's embedding, scoped to the embeddings model."""
+        return hashlib.sha256((model + "\0" + text).encode()).digest()
+
+    def get(self, topic):
+        """
+        Returns the cached summary and links for a topic.
+
+        Parameters
+        ----------
+        topic : str
+            The Wikipedia page title to look up.
+
+        Returns
+        -------
+        tuple or None
+            A tuple of (summary, links) if the topic is cached and fresh, otherwise None.
+        """
+        with self._lock:
+            row = self.conn.execute("SELECT summary, links, fetched_at FROM pages WHERE key = ?", (self._key(topic),)).fetchone()
+        if row is None:
+            return None
+        summary, links, fetched_at = row
+        if time.time() - fetched_at > self.ttl:
+            return None
+        return summary, pickle.loads(zlib.decompress(links))
+
+    def put(self, topic, summary, links):
+        """
+        Stores the summary and links for a topic, replacing any previous entry.
+
+        Parameters
+        ----------
+        topic : str
+            The Wikipedia page title.
+
+        summary : str
+            The summary of the page.
+
+        links : list
+            The validated linked page titles of the page.
+        """
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO pages (key, topic, summary, links, fetched_at) VALUES (?, ?, ?, ?, ?)",
+                (self._key(topic), topic, summary, zlib.compress(pickle.dumps(list(links)), 1), int(time.time())),
+            )
+            self.conn.commit()
+
+    def get_or_fetch(self, topic, fetch_fn):
+        """
+        Returns the cached summary and links for a topic, fetching them on a miss.
+
+        Parameters
+        ----------
+        topic : str
+            The Wikipedia page title to look up.
+
+        fetch_fn : callable
+            A function taking the topic and returning a tuple of (summary, links). It is only called when the
+            topic is missing from the cache or stale.
+
+        Returns
+        -------
+        tuple
+            A tuple of (summary, links) for the topic.
+        """
+        cached = self.get(topic)
+        if cached is not None:
+            return cached
+        summary, links = fetch_fn(topic)
+        self.put(topic, summary, links)
+        return summary, links
+
+    def get_topics(self):
+        """
+        Returns the titles of every fresh cached page, without reading their links.
+
+        Returns
+        -------
+        set
+            The titles of the cached pages.
+        """
+        with self._lock:
+            rows = self.conn.execute("SELECT topic FROM pages WHERE fetched_at >= ?", (int(time.time() - self.ttl),)).fetchall()
+        return {topic for (topic,) in rows}
+
+    def get_embeddings(self, model, texts):
+        """
+        Returns the cached embeddings of the given texts.
+
+        Embeddings do not expire, since they depend only on the text and the model.
+
+        Parameters
+        ----------
+        model : str
+            The name of the embeddings model.
+
+        texts : list[str]
+            The texts to look up.
+
+        Returns
+        -------
+        dict
+            A dictionary mapping each cached text to its embedding as a float32 numpy array. Texts that are not
+            cached are left out.
+        """
+        embeddings = {}
+        with self._lock:
+            for text in dict.fromkeys(texts):
+                row = self.conn.execute("SELECT vector FROM embeddings WHERE key = ?", (self._embedding_key(model, text),)).fetchone()
+                if row is not None:
+                    embeddings[text] = np.frombuffer(row[0], dtype = np.float32)
+        return embeddings
+
+    def put_embeddings(self, model, embeddings):
+        """
+        Stores embeddings of texts, replacing any previous entries.
+
+        Parameters
+        ----------
+        model : str
+            The name of the embeddings model.
+
+        embeddings : dict
+            A dictionary mapping each text to its embedding.
+        """
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(self._embedding_key(model, text), np.asarray(vector, dtype = np.float32).tobytes()) for text, vector in embeddings.items()],
+            )
+            self.conn.commit()
+
+    def close(self):
+        """Closes the database connection. The cache cannot be used afterwards."""
+        with self._lock:
+            self.conn.close()
+
+
+class SemanticLLMCache():
+    """
+    A cache of LLM responses keyed on the embedding of the prompt.
+
+    Consecutive turns often send the LLM nearly the same prompt. This class embeds each prompt and searches a
+    local FAISS inner-product index of previous prompts; when the closest previous prompt has a cosine similarity
+    above the threshold, its stored response is returned without calling the LLM.
+
+    Prompts of different games can be nearly identical while needing different answers (e.g. the same page and
+    links, but another target), so every lookup is made within a scope, and each scope has its own index.
+
+    Attributes
+    ----------
+    embeddings : Embeddings
+        The LangChain embeddings model used to embed prompts.
+    threshold : float
+        The minimum cosine similarity for a previous prompt to count as a hit.
+    path : str or None
+        The path prefix of the file the indexes and responses are persisted to. If None, the cache is in-memory only.
+    hits : int
+        The number of lookups answered from the cache.
+    misses : int
+        The number of lookups that had to call the LLM.
+    save_every : int
+        The number of new responses after which the cache is persisted to disk.
+
+    Methods
+    -------
+    get_or_invoke(prompt, invoke_fn, scope=None, validate=None)
+        Returns the cached response for a similar prompt in the same scope, calling the LLM and storing its
+        response on a miss.
+    save()
+        Persists the indexes and the responses to disk.
+    """
+    def __init__(self, embeddings, threshold = 0.97, path = "llm_cache", save_every = 32):
+        """
+        Initializes the cache, loading previously persisted indexes if they exist.
+
+        Parameters
+        ----------
+        embeddings : Embeddings
+            The LangChain embeddings model used to embed prompts.
+
+        threshold : float, optional
+            The minimum cosine similarity for a previous prompt to count as a hit. Defaults to 0.97.
+
+        path : str, optional
+            The path prefix of the '.pkl' file holding the indexes and responses. If None, nothing is persisted.
+            Defaults to 'llm_cache'.
+
+        save_every : int, optional
+            The number of new responses after which the cache is persisted, so that disk writes do not happen on
+            every miss. Call `save` at shutdown to persist the rest. Defaults to 32.
+        """
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.save_every = save_every
+        self._unsaved = 0
+        self._scopes = {} # scope -> (index, responses), the index is created on the scope's first insert
+        if path and os.path.exists(path + ".pkl"):
+            with open(path + ".pkl", "rb") as f:
+                self._scopes = {scope: (faiss.deserialize_index(index), responses) for scope, (index, responses) in pickle.load(f).items()}
+
+    @property
+    def hit_rate(self):
+        """The fraction of lookups answered from the cache."""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def _embed(self, prompt):
+        """Returns the L2-normalized embedding of a prompt as a (1, d) float32 array."""
+        q = np.asarray([self.embeddings.embed_query(prompt)], dtype = np.float32)
+        faiss.normalize_L2(q)
+        return q
+
+    def save(self):
+        """Persists the indexes and the responses to disk, if a path was given and anything changed."""
+        if not self.path or not self._unsaved:
+            return
+        with open(self.path + ".pkl", "wb") as f:
+            pickle.dump({scope: (faiss.serialize_index(index), responses) for scope, (index, responses) in self._scopes.items()}, f)
+        self._unsaved = 0
+
+    def get_or_invoke(self, prompt, invoke_fn, scope = None, validate = None):
+        """
+        Returns the response to a prompt, from the cache if a similar enough prompt was seen before in the same scope.
+
+        Parameters
+        ----------
+        prompt : str
+            The prompt to send to the LLM.
+
+        invoke_fn : callable
+            A function taking the prompt and returning the LLM response text. It is only called on a miss.
+
+        scope : hashable, optional
+            Only previous prompts with the same scope can be hits. Defaults to None.
+
+        validate : callable, optional
+            A function taking a cached response and returning whether it is still usable for this prompt. Cached
+            responses it rejects are treated as misses. Defaults to None, which accepts every hit.
+
+        Returns
+        -------
+        str
+            The LLM response text.
+        """
+        q = self._embed(prompt)
+        index, responses = self._scopes.get(scope, (None, []))
+        if index is not None:
+            scores, ids = index.search(q, 1)
+            if scores[0][0] > self.threshold:
+                response = responses[ids[0][0]]
+                if validate is None or validate(response):
+                    self.hits += 1
+                    return response
+
+        self.misses += 1
+        response = invoke_fn(prompt)
+        if index is None:
+            index = faiss.IndexFlatIP(q.shape[1])
+            self._scopes[scope] = (index, responses)
+        index.add(q)
+        responses.append(response)
+        self._unsaved += 1
+        if self._unsaved >= self.save_every:
+            self.save()
+        return response
@@ -1,4 +1,5 @@
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from bs4 import BeautifulSoup
 import numpy as np
 from scipy.spatial.distance import cosine
@@ -29,6 +30,33 @@ def get_page_summary(wiki_page):
     # return just the first few lines if there are multiple
     return ". ".join(wiki_page.summary.split("\n")[:5])
 
+def get_page_summaries(wiki_wiki, titles, max_workers = 8):
+    """
+    Retrieves brief summaries of several Wikipedia pages concurrently.
+
+    Each page is fetched through `wiki_wiki` and shortened with `get_page_summary`, exactly as when fetching the
+    pages one at a time, but the requests run in a thread pool so that n summaries cost about one round-trip
+    instead of n sequential ones. Unlike an event loop, this works from Jupyter notebooks as well as Streamlit.
+
+    Parameters
+    ----------
+    wiki_wiki : WikipediaAPI
+        The Wikipedia API connection instance, whose language and user agent are used for the requests.
+
+    titles : list[str]
+        The titles of the Wikipedia pages.
+
+    max_workers : int, optional
+        The maximum number of requests in flight at once, to respect Wikipedia's rate limits. Defaults to 8.
+
+    Returns
+    -------
+    list[str]
+        The summaries of the pages, in the same order as `titles`.
+    """
+    with ThreadPoolExecutor(max_workers = max_workers) as pool:
+        return list(pool.map(lambda title: get_page_summary(wiki_wiki.page(title)), titles))
+
 def get_random_wiki_page(wiki_wiki):
     """
     Selects a random Wikipedia page that meets certain validity criteria.
@@ -139,6 +167,61 @@ def get_most_similar_strings(reference_string: str, candidates_list: list[str],
     most_similar_indices = np.argsort(similarities)[::-1][:n]
     return topics_embs, [candidates_list[i] for i in most_similar_indices], [similarities[i] for i in most_similar_indices]
 
+def shortest_path(get_links, source, target, max_depth = 3, max_expanded = 500):
+    """
+    Finds a shortest chain of links from a source topic to a target topic with a bounded breadth-first search.
+
+    Parameters
+    ----------
+    get_links : callable
+        A function taking a topic and returning the topics it links to, or an empty collection if they are unknown.
+        It is only called for topics the search actually expands.
+
+    source : str
+        The topic to start from.
+
+    target : str
+        The topic to reach.
+
+    max_depth : int, optional
+        The maximum number of links in the chain. Defaults to 3.
+
+    max_expanded : int, optional
+        The maximum number of topics with known links to expand, which bounds the cost of a search that finds no
+        chain however large the link graph grows. Defaults to 500.
+
+    Returns
+    -------
+    list or None
+        The topics on a shortest chain from `source` to `target`, both included, or None if the target cannot be
+        reached within `max_depth` links or after expanding `max_expanded` topics.
+    """
+    if source == target:
+        return [source]
+    parents = {source: None}
+    frontier = [source]
+    expanded = 0
+    for _ in range(max_depth):
+        next_frontier = []
+        for topic in frontier:
+            links = get_links(topic)
+            if links:
+                expanded += 1
+                if expanded > max_expanded:
+                    return None
+            for linked_topic in links:
+                if linked_topic in parents:
+                    continue
+                parents[linked_topic] = topic
+                if linked_topic == target:
+                    path = [linked_topic]
+                    while parents[path[-1]] is not None:
+                        path.append(parents[path[-1]])
+                    return path[::-1]
+                next_frontier.append(linked_topic)
+        frontier = next_frontier
+    return None
+
 def search_wiki(search_term):
     """Search common name for search term and returns most relevant Wiki Page"""
     search_url = f"https://en.wikipedia.org/w/index.php?search={'+'.join(search_term.split())}&title=Special:Search&profile=advanced&fulltext=1&ns0=1"
@@ -0,0 +1,46 @@
+import numpy as np
+from numba import njit
+
+# only contraction and reassociation: the full fastmath set assumes no infs/nans, which the loop must not rely on
+@njit('i8(f4[:,::1], f4[::1])', fastmath = {'contract', 'reassoc'}, cache = True)
+def argmax_cosine(candidates, target):
+    """
+    Finds the row of a matrix of embeddings with the highest cosine similarity to a target embedding.
+
+    This is compiled with numba when this module is imported (the explicit signature makes compilation eager, and
+    `cache = True` reuses the compiled code across runs), so the first turn of a game does not pay the JIT cost.
+
+    Parameters
+    ----------
+    candidates : np.ndarray
+        A C-contiguous float32 array of shape (n, d) containing the candidate embeddings.
+
+    target : np.ndarray
+        A C-contiguous float32 array of shape (d,) containing the target embedding.
+
+    Returns
+    -------
+    int
+        The index of the candidate most similar to the target. Candidates with a zero norm are never selected
+        unless all candidates have a zero norm, in which case 0 is returned.
+    """
+    target_norm = 0.0
+    for i in range(target.shape[0]):
+        target_norm += target[i] * target[i]
+    target_norm = np.sqrt(target_norm)
+
+    best_index = 0
+    best_score = -2.0 # below any cosine similarity
+    for row in range(candidates.shape[0]):
+        dot = 0.0
+        norm = 0.0
+        for i in range(candidates.shape[1]):
+            dot += candidates[row, i] * target[i]
+            norm += candidates[row, i] * candidates[row, i]
+        if norm == 0.0 or target_norm == 0.0:
+            continue
+        score = dot / (np.sqrt(norm) * target_norm)
+        if score > best_score:
+            best_score = score
+            best_index = row
+    return best_index
@@ -3,11 +3,24 @@ import time
 import string
 import wikipediaapi
 from funcs import *
+from kernels import argmax_cosine
+from cache import PageCache, SemanticLLMCache
 from langchain_nvidia_ai_endpoints import NVIDIAEmbeddings, ChatNVIDIA
-from langchain.memory import ConversationBufferMemory
 import os
 import getpass
-import difflib
+from rapidfuzz import process, fuzz
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import re
+import logging
+import threading
+import sys
+import numpy as np
+import pyarrow as pa
+
+log = logging.getLogger(__name__)
+# verbose game progress, kept on a child logger so that configuring it leaves the module logger alone
+progress_log = log.getChild("progress")
 
 
 class WikiGameLLMBot():
@@ -22,9 +35,14 @@ class WikiGameLLMBot():
     ----------
     wiki_wiki : WikipediaAPI
         The Wikipedia API connection instance.
-    game_log : dict
-        A dictionary to log the game's progress, including the start and target topics, turn number, 
-        time taken per turn, current topic and summary, and similarity to the target.
+    page_cache : PageCache
+        The on-disk cache of page summaries and validated links.
+    llm_cache : SemanticLLMCache
+        The cache of LLM responses keyed on prompt embeddings, built on first use by the llm path.
+    game_log : pyarrow.Table
+        A columnar table of the game's progress, including the start and target topics, turn number, 
+        and current topic and summary. The start and target topic columns are dictionary-encoded. With a
+        log_path, only the turns not yet written to it.
     start_topic : str
         The starting topic of the game.
     target_topic : str
@@ -44,13 +62,19 @@ class WikiGameLLMBot():
         Processes a turn in the Wiki game, finding the most similar topic to the target on the current page.
     play_game(verbose=True, clear_cell=False)
         Starts and manages the Wiki game until the target topic is reached.
+    save()
+        Persists the LLM cache and writes the turns logged so far.
+    close()
+        Persists the caches and releases the resources held by the bot.
 
     Raises
     ------
     AssertionError
         If the start and target topics are the same, an assertion error is raised.
     """
-    def __init__(self, wiki_wiki, start_topic = None, target_topic = None, model_name='meta/llama3-70b-instruct', temperature=0.1):
+    log_flush_turns = 1024 # number of buffered turns converted to a columnar table at once
+
+    def __init__(self, wiki_wiki, start_topic = None, target_topic = None, model_name='meta/llama3-70b-instruct', temperature=0.1, cache_path='wiki_cache.sqlite', llm_cache_path='llm_cache', embedding_model='nvidia/nv-embedqa-e5-v5', use_llm=False, log_path=None):
         """
         Initializes the WikiGameBot with the start and target topics.
 
@@ -66,6 +90,23 @@ class WikiGameLLMBot():
         target_topic : str, optional
             The target topic for the Wiki game. If not provided, a random Wikipedia page is chosen.
 
+        cache_path : str, optional
+            The path of the sqlite database caching page summaries and links across games. Defaults to 'wiki_cache.sqlite'.
+
+        llm_cache_path : str, optional
+            The path prefix of the files persisting the semantic LLM response cache. Defaults to 'llm_cache'.
+
+        embedding_model : str, optional
+            The NVIDIA embeddings model used to embed prompts and candidate pages. Defaults to 'nvidia/nv-embedqa-e5-v5'.
+
+        use_llm : bool, optional
+            If True, the LLM selects the next page each turn. Otherwise the candidate whose embedding is closest to
+            the target topic is selected, which costs one embeddings request instead of an LLM call. Defaults to False.
+
+        log_path : str, optional
+            If given, the game log is spilled to this file as an Arrow IPC stream every `log_flush_turns` turns and
+            whenever a game ends, instead of being kept in memory. Defaults to None.
+
         Raises
         ------
         AssertionError
@@ -82,25 +123,59 @@ class WikiGameLLMBot():
                               api_key     = nvidia_api_key,
                               temperature = temperature,
                              )
-        self.memory = ConversationBufferMemory(ai_prefix="System")
+        self.use_llm = use_llm
+        self.embedding_model = embedding_model
+        self.embed = NVIDIAEmbeddings(model    = embedding_model,
+                                      api_key  = nvidia_api_key,
+                                      truncate = "END", # summaries can exceed the model's input limit
+                                     )
+        self.llm_cache_path = llm_cache_path
+        self._llm_cache = None # only built once the llm path is used, see llm_cache
 
         self.wiki_wiki = wiki_wiki
+        self.page_cache = PageCache(cache_path)
+        # links of pages fetched so far, across games, loaded from the page cache as the route search reaches them
+        self._link_graph = {}
+        self._link_graph_lock = threading.Lock() # written by the prefetch threads too
+        self._cached_topics = None # titles in the page cache, loaded on the first route search
+        # memoize per bot so revisited topics skip both Wikipedia and the sqlite cache
+        self._fetch_topic = functools.lru_cache(maxsize=1024)(self._fetch_topic)
+        # pages likely to be picked next are fetched in the background while the next page is being selected
+        self._prefetch_pool = ThreadPoolExecutor(max_workers=5)
+        self._prefetched = {}
         
-        # game log
-        self.game_log = {
-            'starting_topic': [],   # to be able to calculate distance from starting topic to current topic
-            'target_topic': [],     # to be able to calculate distance from target topic to current topic
-            'turn': [],             # int of this turn (so things are sortable)
-            'current_topic': [],    # current topic
-            'current_summary': []
-        }
+        # game log, buffered as lists and flushed to arrow tables every log_flush_turns turns
+        self._log_schema = pa.schema([
+            ('starting_topic', pa.dictionary(pa.int32(), pa.string())),  # to be able to calculate distance from starting topic to current topic
+            ('target_topic', pa.dictionary(pa.int32(), pa.string())),    # to be able to calculate distance from target topic to current topic
+            ('turn', pa.int64()),                                        # int of this turn (so things are sortable)
+            ('current_topic', pa.string()),                              # current topic
+            ('current_summary', pa.string()),
+        ])
+        self._buffers = {name: [] for name in self._log_schema.names}
+        self._log_tables = []
+        self.log_path = log_path
+        self._log_writer = None
         self.printouts = []
 
         # get start and target topics and their respective summaries
         self.get_topics(start_topic, target_topic) # defines self.start_topic and self.target_topic
         assert self.start_topic != self.target_topic, "Please enter different start and target topics."
+
+        # parts of the llm prompt and printouts that are fixed for the whole game
+        self._prompt_prefix = f"""You must are playing the Wikipedia Game where you must find a chain of
+Wikipedia pages that connect a source topic to a target topic. Your source topic was {self.start_topic}
+and your target topic is {self.target_topic}. You are currently at the topic of """
+        self._prompt_suffix = f"""
+Select the topic above most likely to route you to {self.target_topic} as fast as possible. Format your output as:
+Next topic=<topic here>
+"""
+        self._start_display = self.start_topic.replace('_', ' ')
+        self._target_display = self.target_topic.replace('_', ' ')
         
-        target_page = self.wiki_wiki.page(self.target_topic)
+        # only the summary is needed here, so skip the links request unless the page is already cached
+        cached_target = self.page_cache.get(self.target_topic)
+        self.target_summary = cached_target[0] if cached_target else get_page_summary(self.wiki_wiki.page(self.target_topic))
 
     def log_turn(self, turn_dict):
         """
@@ -115,7 +190,40 @@ class WikiGameLLMBot():
             A dictionary containing the details of the current turn to be logged.
         """
         for key, val in turn_dict.items():
-            self.game_log[key].append(val)
+            self._buffers[key].append(val)
+        if len(self._buffers['turn']) >= self.log_flush_turns:
+            self._flush_log()
+
+    def _buffers_to_table(self):
+        """Converts the buffered turns to an arrow table, dictionary-encoding the repeated topic columns."""
+        columns = []
+        for field in self._log_schema:
+            if pa.types.is_dictionary(field.type):
+                columns.append(pa.array(self._buffers[field.name], type = pa.string()).dictionary_encode())
+            else:
+                columns.append(pa.array(self._buffers[field.name], type = field.type))
+        return pa.Table.from_arrays(columns, schema = self._log_schema)
+
+    def _flush_log(self):
+        """Moves the buffered turns into an arrow table, or spills them to `log_path` if one was given."""
+        table = self._buffers_to_table()
+        if self.log_path:
+            if self._log_writer is None:
+                self._log_writer = pa.ipc.new_stream(self.log_path, self._log_schema)
+            self._log_writer.write_table(table)
+        else:
+            self._log_tables.append(table)
+        self._buffers = {name: [] for name in self._log_schema.names}
+
+    @property
+    def game_log(self):
+        """
+        The game log as a pyarrow Table, including turns not yet flushed.
+
+        With `log_path` set, turns already written to disk are not kept in memory, so this only holds the turns not
+        yet written; read the full log from `log_path` instead.
+        """
+        return pa.concat_tables(self._log_tables + [self._buffers_to_table()])
 
     def get_topics(self, start_topic = None, target_topic = None):
         """
@@ -141,6 +249,49 @@ class WikiGameLLMBot():
         else:
             self.target_topic = get_random_wiki_page(self.wiki_wiki)
 
+    def _fetch_page(self, topic):
+        """Fetches the summary and valid linked pages of a topic from Wikipedia."""
+        page = self.wiki_wiki.page(topic)
+        return get_page_summary(page), validate_pages(page)
+
+    def _fetch_topic(self, topic):
+        """Returns the summary and valid linked pages (as a tuple) of a topic. Memoized per bot in __init__."""
+        summary, links = self.page_cache.get_or_fetch(topic, self._fetch_page)
+        with self._link_graph_lock:
+            self._link_graph[topic] = set(links)
+            if self._cached_topics is not None:
+                self._cached_topics.add(topic)
+        return summary, tuple(links)
+
+    def _get_links(self, topic):
+        """Returns the set of known linked pages of a topic, reading the page cache only for topics it holds."""
+        links = self._link_graph.get(topic)
+        if links is not None:
+            return links
+        if self._cached_topics is None:
+            cached_topics = self.page_cache.get_topics()
+            with self._link_graph_lock:
+                if self._cached_topics is None:
+                    self._cached_topics = cached_topics
+        if topic not in self._cached_topics:
+            return () # unknown topics are not stored, so the graph only grows with real pages
+        cached = self.page_cache.get(topic)
+        if cached is None:
+            return ()
+        with self._link_graph_lock:
+            # a prefetch thread may have stored fresher links for this topic meanwhile, keep those
+            return self._link_graph.setdefault(topic, set(cached[1]))
+
+    @staticmethod
+    def _normalize_title(title):
+        """
+        Returns a title in the form Wikipedia resolves it to: underscores as single spaces and a capital first letter.
+
+        Punctuation and the case of later letters are kept, since they tell pages apart (e.g. 'C', 'C++' and 'C#').
+        """
+        title = " ".join(title.replace('_', ' ').split())
+        return title[:1].upper() + title[1:]
+
     def take_turn(self, current_topic, visited):
         """
         Processes a turn in the Wiki game.
@@ -153,57 +304,215 @@ class WikiGameLLMBot():
         current_topic : str
             The current topic being analyzed in the game.
 
-        visited : list
-            A list of already visited topics to avoid repetition.
+        visited : set
+            A set of already visited topics to avoid repetition.
 
         Returns
         -------
-        tuple
-            A tuple containing the most similar topic to the target and its similarity score.
+        str
+            The title of the next page to visit.
+
+        Raises
+        ------
+        RuntimeError
+            If every page linked from the current topic has already been visited and no known route to the target exists.
         """
-        # get API page object for topic
-        current_page = self.wiki_wiki.page(current_topic)
-        self.current_summary = get_page_summary(current_page) # not the best but this works
+        # get summary and valid linked pages for topic, from the prefetch or the cache if seen before
+        if current_topic in self._prefetched:
+            self.current_summary, links = self._prefetched[current_topic].result()
+        else:
+            self.current_summary, links = self._fetch_topic(current_topic)
 
         # get top n valid pages from all linked pages
-        pages = [page for page in validate_pages(current_page) if page not in visited]
+        # also drop spelling variants of visited pages (e.g. 'New York_City' after 'New York City'), which would loop
+        visited_titles = {self._normalize_title(page) for page in visited}
+        pages = [page for page in links if page not in visited and self._normalize_title(page) not in visited_titles]
         pages = pages[:25]
-        if self.target_topic in pages:
-            return self.target_topic, 1
+        # linked titles use spaces, so compare against the display form of the target
+        if self._target_display in pages:
+            return self._target_display
+
+        # if the pages seen so far already connect to the target, follow that route without selecting
+        path = shortest_path(self._get_links, current_topic, self._target_display, max_depth=3)
+        if path and len(path) > 1:
+            return path[1]
+
+        # both selectors need at least one candidate
+        if not pages:
+            raise RuntimeError(f"Dead end at '{current_topic}': every linked page has already been visited.")
+
+        # prefetch the pages whose titles look closest to the target while the next page is selected
+        likely_pages = [match[0] for match in process.extract(self._target_display, pages, scorer=fuzz.WRatio, limit=5)]
+        self._prefetched = {page: self._prefetch_pool.submit(self._fetch_topic, page) for page in likely_pages}
 
-        # Select the base pages with the llm
-        template = """You must are playing the Wikipedia Game where you must find a chain of
-Wikipedia pages that connect a source topic to a target topic. Your source topic was {source}
-and your target topic is {target1}. You are currently at the topic of {current}, and you must select
+        # select the next page by embedding similarity to the target, or with the llm
+        if self.use_llm:
+            return self._select_with_llm(current_topic, pages)
+        return self._select_with_embeddings(pages)
+
+    def _select_with_embeddings(self, pages):
+        """
+        Selects the candidate page whose title embedding is closest to the target summary's.
+
+        All candidates and the target summary are embedded in a single batched request; embeddings already in the page
+        cache are reused so only novel titles are sent.
+
+        Parameters
+        ----------
+        pages : list
+            The candidate page titles.
+
+        Returns
+        -------
+        str
+            The candidate page title with the highest cosine similarity to the target summary.
+        """
+        # fall back to the target title if its page has no summary, an empty input is rejected by the endpoint
+        texts = pages + [self.target_summary or self._target_display]
+        vectors = self.page_cache.get_embeddings(self.embedding_model, texts)
+        novel = [text for text in dict.fromkeys(texts) if text not in vectors]
+        if novel:
+            embedded = dict(zip(novel, self.embed.embed_documents(novel))) # one HTTP round-trip
+            self.page_cache.put_embeddings(self.embedding_model, embedded)
+            vectors.update(embedded)
+
+        matrix = np.asarray([vectors[text] for text in texts], dtype = np.float32)
+        return pages[argmax_cosine(matrix[:-1], matrix[-1])]
+
+    def _select_with_llm(self, current_topic, pages):
+        """
+        Asks the LLM which candidate page is most likely to route to the target topic.
+
+        Parameters
+        ----------
+        current_topic : str
+            The current topic being analyzed in the game.
+
+        pages : list
+            The candidate page titles.
+
+        Returns
+        -------
+        str
+            The candidate page title closest to the LLM's proposed topic.
+        """
+        # Select the base pages with the llm, only the current topic and links change between turns
+        links = '\n'.join(pages)
+        template = self._prompt_prefix + f"""{current_topic}, and you must select
 a new topic from the linked pages here that will make it likely for you to connect to the target topic
 soon. Your possible choices are:
 
 {links}
+""" + self._prompt_suffix
+        log.debug("%s", template)
+        # a cached response is only used if it was given for this target and names one of these pages exactly
+        titles = {self._normalize_title(page) for page in pages}
+        response = self.llm_cache.get_or_invoke(template, self._stream_next_topic, scope = self.target_topic,
+                                                validate = lambda cached: self._normalize_title(self._parse_proposed_page(cached)) in titles)
+        log.debug("Response\n%s", response)
 
-Select the topic above most likely to route you to {target2} as fast as possible. Format your output as:
-Next topic=<topic here>
-"""
-        template = template.format(source  = self.start_topic,
-                                   target1 = self.target_topic,
-                                   current = current_topic,
-                                   links   = '\n'.join(pages),
-                                   target2 = self.target_topic
-                                  )
-        print(template)
-        response = self.llm.invoke(template)
-        print("Response")
-        print(response)
-        
-        print("Parsed Response")
-        proposedPage = response.content.split('=')[1]
-        print(proposedPage)
-        
-        print("Most similar page")
-        most_similar = difflib.get_close_matches(proposedPage, pages, n=1)[0]
-        print(most_similar)
+        most_similar, _ = self._match_proposed_page(response, pages)
+        log.debug("Most similar page\n%s", most_similar)
 
         return most_similar
+
+    @staticmethod
+    def _parse_proposed_page(response):
+        """Returns the topic named on the 'Next topic=' line of an LLM response, or the whole response if there is none."""
+        match = re.search(r"Next topic=\s*([^\n]+)", response)
+        return (match.group(1) if match else response).strip()
+
+    def _match_proposed_page(self, response, pages):
+        """
+        Parses the 'Next topic=' line of an LLM response and matches it to the closest candidate page.
+
+        Parameters
+        ----------
+        response : str
+            The LLM response text.
+
+        pages : list
+            The candidate page titles.
+
+        Returns
+        -------
+        tuple
+            A tuple of the closest candidate page (or None if there are no candidates) and its WRatio score out of 100.
+        """
+        proposedPage = self._parse_proposed_page(response)
+        log.debug("Parsed Response\n%s", proposedPage)
+
+        match = process.extractOne(proposedPage.strip(), pages, scorer=fuzz.WRatio)
+        return (match[0], match[1]) if match else (None, 0)
     
+    @property
+    def llm_cache(self):
+        """The semantic LLM response cache, loaded from disk on first use."""
+        if self._llm_cache is None:
+            self._llm_cache = SemanticLLMCache(self.embed, path=self.llm_cache_path)
+        return self._llm_cache
+
+    def save(self):
+        """
+        Persists the LLM cache and writes the turns logged so far, keeping the bot usable.
+
+        This is called whenever `play_game` returns or is interrupted.
+        """
+        if self._llm_cache is not None:
+            self._llm_cache.save()
+        if self._buffers['turn']:
+            self._flush_log()
+
+    def close(self):
+        """
+        Persists the caches and releases the resources held by the bot. The bot cannot be used afterwards.
+
+        Call this (or use the bot as a context manager) once done with the bot, e.g. after the last game of an
+        evaluation run.
+        """
+        self.save()
+        # end the arrow stream
+        if self._log_writer is not None:
+            self._log_writer.close()
+            self._log_writer = None
+        # pending prefetches are not needed anymore, and their threads would outlive the bot
+        self._prefetch_pool.shutdown(wait=False, cancel_futures=True)
+        self._prefetched = {}
+        self.page_cache.close()
+
+    def __enter__(self):
+        """Returns the bot, so it can be used in a with statement that closes it on exit."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Closes the bot when leaving the with statement."""
+        self.close()
+
+    def _stream_next_topic(self, prompt):
+        """
+        Streams the LLM's response to a prompt, stopping as soon as a full 'Next topic=' line has been generated.
+
+        Only the 'Next topic=' line of the response is used, so the rest of the completion is not waited for.
+
+        Parameters
+        ----------
+        prompt : str
+            The prompt to send to the LLM.
+
+        Returns
+        -------
+        str
+            The response text generated up to and including the 'Next topic=' line.
+        """
+        response = ""
+        stream = self.llm.stream(prompt)
+        for chunk in stream:
+            response += chunk.content
+            if re.search(r"Next topic=\s*[^\n]+\n", response):
+                break
+        stream.close() # stop generation server-side if we broke out early
+        return response
+
     def play_game(self, verbose = True):
         """
         Starts and manages the Wiki game until the target topic is reached.
@@ -219,6 +528,15 @@ Next topic=<topic here>
         clear_cell : bool, optional
             If True, clears the output cell every four turns (useful in interactive environments). Defaults to False.
         """
+        # verbose progress goes through the progress logger, give it a stdout handler the first time
+        # (not propagated, so it is not printed twice if the caller configured root logging)
+        if verbose and not progress_log.handlers:
+            handler = logging.StreamHandler(sys.stdout)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            progress_log.addHandler(handler)
+            progress_log.setLevel(logging.INFO)
+            progress_log.propagate = False
+
         # turn number
         turn_num = 1
 
@@ -229,49 +547,52 @@ Next topic=<topic here>
         visited = set()
 
         # keep playing until target is reached
-        while True:
-
-            # for turn time tracking
-            turn_start = time.time()
-
-            # find most similar topic on current page to target topic
-            visited.add(current_topic)
-            next_topic = self.take_turn(current_topic, list(visited))
-
-            # for turn time tracking
-            turn_time = time.time() - turn_start
-
-            self.log_turn(
-                {
-                    'starting_topic': self.start_topic,
-                    'target_topic': self.start_topic,
-                    'turn': turn_num,             
-                    'current_topic': current_topic,
-                    'current_summary': self.current_summary
-                }
-            )
-
-            if verbose:
-                printouts = [
-                    "-" * 50,
-                    f"Turn: {turn_num}",
-                    f"Start topic: {self.start_topic.replace('_', ' ')}",
-                    f"Current topic: {current_topic.replace('_', ' ')}",
-                    f"Next topic: {next_topic.replace('_', ' ')}",
-                    f"Target topic: {self.target_topic.replace('_', ' ')}",
-                ]
-
-                self.printouts.append(printouts)
-
-                # print progress
-                for i in self.printouts[-1]:
-                    print(i)
-
-            # else, set new next_topic to current topic and loop
-            current_topic = next_topic
-
-            # increment turn
-            turn_num += 1
+        try:
+            while True:
+
+                # for turn time tracking
+                turn_start = time.time()
+
+                # find most similar topic on current page to target topic
+                visited.add(current_topic)
+                next_topic = self.take_turn(current_topic, visited)
+
+                # for turn time tracking
+                turn_time = time.time() - turn_start
+
+                self.log_turn(
+                    {
+                        'starting_topic': self.start_topic,
+                        'target_topic': self.start_topic,
+                        'turn': turn_num,             
+                        'current_topic': current_topic,
+                        'current_summary': self.current_summary
+                    }
+                )
+
+                if verbose:
+                    printouts = [
+                        "-" * 50,
+                        f"Turn: {turn_num}",
+                        f"Start topic: {self._start_display}",
+                        f"Current topic: {current_topic.replace('_', ' ')}",
+                        f"Next topic: {next_topic.replace('_', ' ')}",
+                        f"Target topic: {self._target_display}",
+                    ]
+
+                    self.printouts.append(printouts)
+
+                    # print progress
+                    for i in self.printouts[-1]:
+                        progress_log.info(i)
+
+                # else, set new next_topic to current topic and loop
+                current_topic = next_topic
+
+                # increment turn
+                turn_num += 1
+        finally:
+            self.save()
 
 """
 Example usage: